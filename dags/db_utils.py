@@ -1,8 +1,14 @@
+import io
 import os
 import logging
-from typing import List, Dict, Any, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Dict, Any, Optional
+import pandas as pd
+from psycopg2.errors import UndefinedTable
+from psycopg2.extras import execute_values
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import ProgrammingError
 
 # ─── Logging setup ───
 log = logging.getLogger("db_utils")
@@ -15,6 +21,15 @@ if not log.handlers:
 
 # ─── Global engine cache ───
 _engine: Optional[Engine] = None
+# Whether reddit_comments is range-partitioned; tables created before partitioning are not
+_partitioned: Optional[bool] = None
+# Table and index DDL runs once per process; CREATE INDEX locks every partition even when it is a no-op
+_table_ready = False
+
+_UPSERT_PAGE_SIZE = 500
+# Above this many rows, COPY into a staging table beats multi-row INSERTs
+_COPY_THRESHOLD = 5000
+_UPSERT_COLUMNS = ("id", "subreddit", "comment_clean", "sentiment", "confidence", "created_utc", "url")
 
 def _get_engine() -> Engine:
     global _engine
@@ -28,20 +43,155 @@ def _get_engine() -> Engine:
     return _engine
 
 def _ensure_table_exists(engine: Engine):
+    global _partitioned, _table_ready
+    if _table_ready:
+        return
+
+    # Partitioned by day on created_utc; the primary key must include the partition key
     ddl = text("""
         CREATE TABLE IF NOT EXISTS reddit_comments (
-            id TEXT PRIMARY KEY,
+            id TEXT NOT NULL,
             subreddit TEXT,
             comment_clean TEXT,
             sentiment TEXT,
             confidence FLOAT,
-            created_utc TIMESTAMP,
-            url TEXT
-        );
+            created_utc TIMESTAMP NOT NULL,
+            url TEXT,
+            PRIMARY KEY (id, created_utc)
+        ) PARTITION BY RANGE (created_utc);
     """)
+    # The dashboard filters on subreddit/sentiment and orders by created_utc
+    indexes = [
+        text("CREATE INDEX IF NOT EXISTS idx_reddit_comments_subreddit_sentiment ON reddit_comments (subreddit, sentiment)"),
+        text("CREATE INDEX IF NOT EXISTS idx_reddit_comments_created_utc ON reddit_comments (created_utc)"),
+    ]
     with engine.begin() as conn:
         conn.execute(ddl)
-    log.info("Verified reddit_comments table exists")
+        for index in indexes:
+            conn.execute(index)
+        _partitioned = bool(conn.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'reddit_comments'::regclass)"
+        )).scalar())
+    _table_ready = True
+    log.info("Verified reddit_comments table exists (partitioned=%s)", _partitioned)
+
+def _ensure_partitions(engine: Engine, created_utc: Iterable[int]):
+    """Create the daily partitions (UTC days) that the given epoch timestamps fall into."""
+    if not _partitioned:
+        return
+
+    days = sorted({datetime.fromtimestamp(int(ts), timezone.utc).date() for ts in created_utc})
+    with engine.begin() as conn:
+        for day in days:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS reddit_comments_p{day:%Y%m%d}
+                PARTITION OF reddit_comments
+                FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')
+            """))
+
+def _conflict_target() -> str:
+    return "(id, created_utc)" if _partitioned else "(id)"
+
+def fetch_comment_ids_since(created_utc: int, subreddit: Optional[str] = None) -> List[str]:
+    """
+    Return ids of comments already stored with created_utc at or after the given epoch.
+    """
+    sql = "SELECT id FROM reddit_comments WHERE created_utc >= to_timestamp(:ts) AT TIME ZONE 'UTC'"
+    params: Dict[str, Any] = {"ts": created_utc}
+    if subreddit:
+        sql += " AND subreddit = :subreddit"
+        params["subreddit"] = subreddit
+
+    # Read-only: every mapped extract task calls this, so it must not run the table DDL
+    try:
+        with _get_engine().connect() as conn:
+            return list(conn.execute(text(sql), params).scalars())
+    except ProgrammingError as e:
+        if isinstance(e.orig, UndefinedTable):
+            return []  # Nothing has been loaded yet
+        raise
+
+def _normalize_rows(rows: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Coerce column types in one vectorized pass and drop duplicate ids."""
+    df = pd.DataFrame(rows).reindex(columns=list(_UPSERT_COLUMNS))
+
+    # Normalize timestamp
+    df["created_utc"] = pd.to_numeric(df["created_utc"], errors="coerce").fillna(0).astype("int64")
+
+    # Ensure sentiment is a string
+    df["sentiment"] = df["sentiment"].fillna("neutral").astype(str)
+
+    # Ensure confidence is a float
+    confidence = pd.to_numeric(df["confidence"], errors="coerce")
+    invalid = confidence.isna() & df["confidence"].notna()
+    if invalid.any():
+        log.warning("Invalid confidence for %d row(s) (e.g. id=%s), defaulting to 0.0",
+                    int(invalid.sum()), df.loc[invalid, "id"].iloc[0])
+    df["confidence"] = confidence.fillna(0.0)
+
+    # A multi-row INSERT ... ON CONFLICT cannot touch the same id twice, keep the latest
+    df = df.drop_duplicates(subset="id", keep="last")
+
+    # Object dtype hands psycopg2 native Python values, with None for missing cells
+    return df.astype(object).where(df.notna(), None)
+
+def _copy_upsert(engine: Engine, df: pd.DataFrame) -> int:
+    """COPY normalized rows into a temp staging table, then upsert them set-based."""
+    buf = io.StringIO()
+    df.to_csv(buf, columns=list(_UPSERT_COLUMNS), index=False, header=False)
+    buf.seek(0)
+
+    columns = ", ".join(_UPSERT_COLUMNS)
+    with engine.begin() as conn:
+        cur = conn.connection.cursor()
+        try:
+            # created_utc stays epoch seconds here so the conversion matches the INSERT path
+            cur.execute("""
+                CREATE TEMP TABLE stg_reddit_comments (
+                    id TEXT,
+                    subreddit TEXT,
+                    comment_clean TEXT,
+                    sentiment TEXT,
+                    confidence FLOAT,
+                    created_utc BIGINT,
+                    url TEXT
+                ) ON COMMIT DROP
+            """)
+            cur.copy_expert(f"COPY stg_reddit_comments ({columns}) FROM STDIN WITH (FORMAT csv)", buf)
+            cur.execute(f"""
+                INSERT INTO reddit_comments ({columns})
+                SELECT id, subreddit, comment_clean, sentiment, confidence,
+                       to_timestamp(created_utc) AT TIME ZONE 'UTC', url
+                FROM stg_reddit_comments
+                ON CONFLICT {_conflict_target()} DO UPDATE
+                SET
+                    sentiment = EXCLUDED.sentiment,
+                    confidence = EXCLUDED.confidence
+            """)
+            return cur.rowcount
+        finally:
+            cur.close()
+
+def bulk_copy_upsert(rows: List[Dict[str, Any]]) -> int:
+    """
+    Upsert Reddit comments through COPY FROM STDIN, for large backfills.
+    """
+    if not rows:
+        log.info("No rows to upsert")
+        return 0
+
+    df = _normalize_rows(rows)
+    engine = _get_engine()
+    _ensure_table_exists(engine)
+    _ensure_partitions(engine, df["created_utc"])
+
+    try:
+        count = _copy_upsert(engine, df)
+        log.info("Upserted %d rows via COPY", count)
+        return count
+    except Exception as e:
+        log.exception("Failed to bulk upsert comments: %s", e)
+        raise
 
 def upsert_comments(rows: List[Dict[str, Any]]) -> int:
     """
@@ -51,42 +201,37 @@ def upsert_comments(rows: List[Dict[str, Any]]) -> int:
         log.info("No rows to upsert")
         return 0
 
-    for r in rows:
-        # Normalize timestamp
-        try:
-            r["created_utc"] = int(float(r.get("created_utc", 0)))
-        except Exception:
-            r["created_utc"] = 0
+    if len(rows) > _COPY_THRESHOLD:
+        return bulk_copy_upsert(rows)
 
-        # Ensure sentiment is a string
-        r["sentiment"] = str(r.get("sentiment", "neutral"))
+    df = _normalize_rows(rows)
+    values = list(df.itertuples(index=False, name=None))
 
-        # Ensure confidence is a float
-        try:
-            r["confidence"] = float(r.get("confidence", 0))
-        except (TypeError, ValueError):
-            log.warning("Invalid confidence for id=%s, defaulting to 0.0", r.get("id"))
-            r["confidence"] = 0.0
+    engine = _get_engine()
+    _ensure_table_exists(engine)
+    _ensure_partitions(engine, df["created_utc"])
 
-    sql = text("""
+    sql = f"""
         INSERT INTO reddit_comments
             (id, subreddit, comment_clean, sentiment, confidence, created_utc, url)
-        VALUES
-            (:id, :subreddit, :comment_clean, :sentiment, :confidence, to_timestamp(:created_utc), :url)
-        ON CONFLICT (id) DO UPDATE
+        VALUES %s
+        ON CONFLICT {_conflict_target()} DO UPDATE
         SET
             sentiment = EXCLUDED.sentiment,
             confidence = EXCLUDED.confidence
-    """)
-
-    engine = _get_engine()
-    _ensure_table_exists(engine)
+    """
+    # created_utc is stored as naive UTC so rows land in the matching daily partition
+    template = "(%s, %s, %s, %s, %s, to_timestamp(%s) AT TIME ZONE 'UTC', %s)"
 
     try:
         with engine.begin() as conn:
-            result = conn.execute(sql, rows)
-            log.info("Upserted %d rows", result.rowcount)
-            return result.rowcount
+            cur = conn.connection.cursor()
+            try:
+                execute_values(cur, sql, values, template=template, page_size=_UPSERT_PAGE_SIZE)
+            finally:
+                cur.close()
+            log.info("Upserted %d rows", len(values))
+            return len(values)
     except Exception as e:
         log.exception("Failed to upsert comments: %s", e)
-        raise
\ No newline at end of file
+        raise
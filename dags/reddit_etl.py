@@ -1,21 +1,29 @@
 import os
 import sys
+import json
 import time
+import fcntl
+import asyncio
 import logging
-from typing import List, Dict, Any, Optional
+import functools
+import contextlib
+from typing import Any, Container, Dict, Iterator, List, Optional, Set, Tuple
 from datetime import datetime, timezone, timedelta
 
 from airflow import DAG
 from airflow.decorators import task
 from airflow.models import Variable
-import praw
+from airflow.operators.python import get_current_context
+import ahocorasick
+import asyncpraw
+from asyncprawcore.exceptions import Forbidden, NotFound, Redirect
 
 # ──────────────────────────────────────────────
 # Add DAG folder to Python path
 # ──────────────────────────────────────────────
 sys.path.append(os.path.dirname(__file__))
 
-from db_utils import upsert_comments  # lightweight import
+from db_utils import fetch_comment_ids_since, upsert_comments  # lightweight import
 
 # ──────────────────────────────────────────────
 # Logging setup
@@ -58,6 +66,10 @@ DEFAULT_KEYWORDS = [
     "amma canteen", "kalia scheme", "shakti scheme"
 ] + [s.lower() for s in STATE_NAMES]
 
+# One slot per bot (created by airflow-init); bounds how many extract tasks run at once
+BOT_POOL = "reddit_bots"
+BOT_LOCK_DIR = os.getenv("REDDIT_BOT_LOCK_DIR", "/tmp")
+
 default_args = {
     "owner": "mani",
     "retries": 2,
@@ -79,14 +91,126 @@ def _parse_csv_var(name: str, default_list: List[str]) -> List[str]:
     raw = _get_var(name, ",".join(default_list))
     return [p.strip() for p in raw.split(",") if p.strip()] if raw else default_list
 
-def _get_reddit_client() -> praw.Reddit:
-    """Initialize and return a Reddit API client."""
-    return praw.Reddit(
-        client_id=Variable.get("REDDIT_CLIENT_ID"),
-        client_secret=Variable.get("REDDIT_CLIENT_SECRET"),
-        user_agent=Variable.get("REDDIT_USER_AGENT", "reddit_sentiment_bot/0.1")
+@functools.lru_cache(maxsize=8)
+def _keyword_automaton(keywords: Tuple[str, ...]) -> "ahocorasick.Automaton":
+    """Build (once per worker and keyword set) a single-pass multi-keyword matcher."""
+    automaton = ahocorasick.Automaton()
+    for kw in keywords:
+        if kw:
+            automaton.add_word(kw.lower(), kw)
+    automaton.make_automaton()
+    return automaton
+
+def _matches_any(automaton: "ahocorasick.Automaton", text: str) -> bool:
+    """True if any keyword occurs as a substring of text."""
+    # An automaton without words cannot be searched
+    return len(automaton) > 0 and next(automaton.iter(text), None) is not None
+
+def _seen_comment_ids(since_ts: int, sub: str) -> Set[str]:
+    """Exact set of ids already loaded for this subreddit since since_ts."""
+    try:
+        seen = set(fetch_comment_ids_since(since_ts, sub))
+        log.info("r/%s: %d comments already loaded today", sub, len(seen))
+        return seen
+    except Exception as e:
+        log.warning("Could not load existing ids for r/%s, processing all comments: %s", sub, e)
+        return set()
+
+def _get_bot_credentials() -> List[Dict[str, str]]:
+    """Read the REDDIT_BOTS Variable (JSON list of {client_id, client_secret}), falling back to the single bot."""
+    raw = _get_var("REDDIT_BOTS")
+    if raw:
+        try:
+            bots = [b for b in json.loads(raw) if b.get("client_id") and b.get("client_secret")]
+            if bots:
+                return bots
+        except Exception as e:
+            log.warning("Invalid REDDIT_BOTS variable, using single client: %s", e)
+    return [{
+        "client_id": Variable.get("REDDIT_CLIENT_ID"),
+        "client_secret": Variable.get("REDDIT_CLIENT_SECRET"),
+    }]
+
+@contextlib.contextmanager
+def _claim_bot(bots: List[Dict[str, str]], preferred: int) -> Iterator[Dict[str, str]]:
+    """
+    Hold an exclusive lock on one free bot for the duration of the block, starting
+    from bots[preferred]. Each credential then serves at most one task at a time,
+    which keeps it within its own Reddit request budget.
+    """
+    while True:
+        for k in range(len(bots)):
+            bot = bots[(preferred + k) % len(bots)]
+            lock_file = open(os.path.join(BOT_LOCK_DIR, f"reddit_bot_{bot['client_id']}.lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            try:
+                yield bot
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        time.sleep(1)
+
+def _get_reddit_client(bot: Dict[str, str]) -> asyncpraw.Reddit:
+    """Initialize an async Reddit API client for one bot (must be called inside the event loop)."""
+    return asyncpraw.Reddit(
+        client_id=bot["client_id"],
+        client_secret=bot["client_secret"],
+        user_agent=bot.get("user_agent") or _get_var("REDDIT_USER_AGENT", "reddit_sentiment_bot/0.1")
     )
 
+async def _fetch_subreddit(
+    bot: Dict[str, str],
+    sub: str,
+    keywords: List[str],
+    max_comments: int,
+    today_ts: int,
+    seen_ids: Container[str] = (),
+) -> List[Dict[str, Any]]:
+    """Collect today's keyword-matching comments from one subreddit, skipping seen_ids."""
+    rows: List[Dict[str, Any]] = []
+    automaton = _keyword_automaton(tuple(keywords))
+    async with _get_reddit_client(bot) as reddit:
+        log.info("🔍 Fetching comments from r/%s", sub)
+        try:
+            subreddit = await reddit.subreddit(sub, fetch=True)
+        except (Forbidden, NotFound, Redirect) as e:
+            # Private, banned or misspelled subreddits will not recover on retry
+            log.warning("⚠️ Skipping r/%s due to error: %s", sub, e)
+            return rows
+
+        if getattr(subreddit, "subreddit_type", "public") != "public":
+            log.info("Skipping non-public subreddit %s", sub)
+            return rows
+
+        async for comment in subreddit.comments(limit=max_comments):
+            created = int(getattr(comment, "created_utc", 0))
+            if created < today_ts:
+                continue
+
+            if getattr(comment, "id", "") in seen_ids:
+                continue
+
+            body = (getattr(comment, "body", "") or "").strip()
+            if not body:
+                continue
+
+            if _matches_any(automaton, body.lower()):
+                rows.append({
+                    "id": getattr(comment, "id", ""),
+                    "subreddit": sub,
+                    "body": body.replace("\n", " "),
+                    "created_utc": created,
+                    "permalink": f"https://reddit.com{getattr(comment, 'permalink', '')}"
+                })
+
+    log.info("✅ r/%s: collected %d comments", sub, len(rows))
+    return rows
+
 # ──────────────────────────────────────────────
 # DAG Definition
 # ──────────────────────────────────────────────
@@ -99,68 +223,45 @@ with DAG(
     tags=["reddit", "etl", "sentiment"],
 ) as dag:
 
-    # ─── Extract Task ───
+    # ─── List Task ───
     @task()
-    def extract_comments() -> List[Dict[str, Any]]:
-        reddit = _get_reddit_client()
+    def list_subreddits() -> List[str]:
         subreddits = _parse_csv_var("SUBREDDITS", DEFAULT_SUBREDDITS)
+        log.info("Mapping extraction over %d subreddits", len(subreddits))
+        return subreddits
+
+    # ─── Extract Task (mapped per subreddit) ───
+    @task(pool=BOT_POOL)
+    def extract_one(sub: str) -> List[Dict[str, Any]]:
         keywords = _parse_csv_var("KEYWORDS", DEFAULT_KEYWORDS)
         max_comments = int(_get_var("MAX_COMMENTS", "1000"))
-        sleep_time = float(_get_var("SLEEP_TIME_SECONDS", "2"))
 
         today_ts = int(datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
-        rows: List[Dict[str, Any]] = []
+        seen_ids = _seen_comment_ids(today_ts, sub)
 
-        for sub in subreddits:
-            try:
-                log.info("🔍 Fetching comments from r/%s", sub)
-                subreddit = reddit.subreddit(sub)
-
-                if getattr(subreddit, "subreddit_type", "public") != "public":
-                    log.info("Skipping non-public subreddit %s", sub)
-                    continue
-
-                for comment in subreddit.comments(limit=max_comments):
-                    created = int(getattr(comment, "created_utc", 0))
-                    if created < today_ts:
-                        continue
-
-                    body = (getattr(comment, "body", "") or "").strip()
-                    if not body:
-                        continue
-
-                    text = body.lower()
-                    if any(kw in text for kw in keywords):
-                        rows.append({
-                            "id": getattr(comment, "id", ""),
-                            "subreddit": sub,
-                            "body": body.replace("\n", " "),
-                            "created_utc": created,
-                            "permalink": f"https://reddit.com{getattr(comment, 'permalink', '')}"
-                        })
-
-                log.info("✅ r/%s: collected %d comments", sub, len(rows))
-                time.sleep(sleep_time)
-
-            except Exception as e:
-                log.warning("⚠️ Skipping r/%s due to error: %s", sub, e)
-
-        log.info("📦 Extracted total %d comments", len(rows))
-        return rows
+        # Start round-robin from the map index, but never share a bot with a running task
+        bots = _get_bot_credentials()
+        map_index = max(get_current_context()["ti"].map_index, 0)
+        with _claim_bot(bots, map_index % len(bots)) as bot:
+            return asyncio.run(_fetch_subreddit(bot, sub, keywords, max_comments, today_ts, seen_ids))
 
     # ─── Transform Task ───
-    @task()
-    def transform_comments(raw: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # One task over all subreddits: models load once and inference runs in full batches.
+    # all_done: one failing subreddit should not hold back the others' rows
+    @task(trigger_rule="all_done")
+    def transform_comments(batches: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        raw = [item for batch in batches for item in (batch or [])]
         if not raw:
             log.info("No comments to transform")
             return []
 
-        from sentiment_model import score_sentiment  # Safe local import
+        from sentiment_model import score_sentiment_batch  # Safe local import
+
+        scores = score_sentiment_batch([item.get("body") or "" for item in raw])
 
         transformed = []
-        for item in raw:
+        for item, (sentiment, confidence) in zip(raw, scores):
             try:
-                sentiment, confidence = score_sentiment(item["body"])
                 transformed.append({
                     "id": item["id"],
                     "subreddit": item["subreddit"],
@@ -194,6 +295,6 @@ with DAG(
             return 0
 
     # ─── Task Chain ───
-    raw_comments = extract_comments()
+    raw_comments = extract_one.expand(sub=list_subreddits())
     processed_comments = transform_comments(raw_comments)
-    load_comments(processed_comments)
\ No newline at end of file
+    load_comments(processed_comments)
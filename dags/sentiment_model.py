@@ -1,8 +1,15 @@
+import os
+import fcntl
+import hashlib
 import logging
-from typing import Tuple
+import functools
+import shutil
+import tempfile
+from typing import Any, Dict, List, Optional, Set, Tuple
 import re
-from langdetect import detect
-from transformers import pipeline
+import torch
+from langdetect import DetectorFactory, detect
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
 # ─── Logging Setup ───
 log = logging.getLogger("sentiment_model")
@@ -14,13 +21,118 @@ if not log.handlers:
     )
 
 # ─── Load Transformer Models ───
+EN_MODEL_ID = "distilbert-base-uncased-finetuned-sst-2-english"
+MULTI_MODEL_ID = "nlptown/bert-base-multilingual-uncased-sentiment"
+MODEL_CACHE_DIR = os.getenv("SENTIMENT_MODEL_DIR", "/opt/airflow/models")
+_QUANTIZED_FILE = "model_quantized.onnx"
+
+def _quantized_model_dir(model_id: str) -> str:
+    """Export model_id to ONNX with dynamic INT8 quantization, once per cache dir."""
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    target = os.path.join(MODEL_CACHE_DIR, model_id.replace("/", "__") + "-int8")
+    if os.path.exists(os.path.join(target, _QUANTIZED_FILE)):
+        return target
+
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    # Concurrent workers would otherwise each export and quantize the same model
+    with open(os.path.join(MODEL_CACHE_DIR, ".quantize.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(os.path.join(target, _QUANTIZED_FILE)):
+                return target
+
+            log.info("Quantizing %s to INT8 ONNX under %s", model_id, target)
+            work_dir = tempfile.mkdtemp(dir=MODEL_CACHE_DIR)
+            try:
+                ort_model = ORTModelForSequenceClassification.from_pretrained(model_id, export=True)
+                quantizer = ORTQuantizer.from_pretrained(ort_model)
+                qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+                quantizer.quantize(save_dir=work_dir, quantization_config=qconfig)
+                ort_model.config.save_pretrained(work_dir)
+                AutoTokenizer.from_pretrained(model_id).save_pretrained(work_dir)
+                # Rename last so a crash never leaves a half-written target behind
+                os.rename(work_dir, target)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return target
+
+def _inference_threads() -> int:
+    """Split cores between concurrently running workers instead of oversubscribing them."""
+    threads = os.getenv("SENTIMENT_INFERENCE_THREADS")
+    if threads:
+        return int(threads)
+    n_workers = int(os.getenv("SENTIMENT_CONCURRENT_WORKERS", "4"))
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+def _load_model(model_id: str, n_threads: int) -> Tuple[Any, Any]:
+    """Load (tokenizer, INT8 ONNX Runtime model), falling back to the FP32 PyTorch model."""
+    try:
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+
+        model_dir = _quantized_model_dir(model_id)
+        # ONNX Runtime keeps its own thread pool, sized to every core unless told otherwise
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = n_threads
+        model = ORTModelForSequenceClassification.from_pretrained(
+            model_dir, file_name=_QUANTIZED_FILE, session_options=session_options
+        )
+        return AutoTokenizer.from_pretrained(model_dir), model
+    except Exception as e:
+        log.warning("INT8 ONNX model unavailable for %s, using FP32 model: %s", model_id, e)
+        model = AutoModelForSequenceClassification.from_pretrained(model_id).eval()
+        return AutoTokenizer.from_pretrained(model_id), model
+
+# Loaded on first use and shared for the process lifetime
+_MODELS: Optional[Dict[str, Optional[Tuple[Any, Any]]]] = None
+
+def get_models() -> Dict[str, Optional[Tuple[Any, Any]]]:
+    """Return {"en": ..., "multi": ...} (tokenizer, model) pairs, loading them once per process."""
+    global _MODELS
+    if _MODELS is None:
+        n_threads = _inference_threads()
+        torch.set_num_threads(n_threads)
+        try:
+            _MODELS = {
+                "en": _load_model(EN_MODEL_ID, n_threads),
+                "multi": _load_model(MULTI_MODEL_ID, n_threads),
+            }
+        except Exception as e:
+            log.exception("Failed to load sentiment models: %s", e)
+            _MODELS = {"en": None, "multi": None}
+    return _MODELS
+
+# ─── Load Language ID Model ───
+LID_MODEL_PATH = os.getenv("LID_MODEL_PATH", "/opt/airflow/lid.176.ftz")
+_LID_LABEL_PREFIX = "__label__"
+
+try:
+    import fasttext
+    _LID = fasttext.load_model(LID_MODEL_PATH)
+except Exception as e:
+    log.warning("fastText language ID unavailable, falling back to langdetect: %s", e)
+    _LID = None
+
+# langdetect is randomized; a fixed seed makes results deterministic and memoizable
+DetectorFactory.seed = 0
+_LANGDETECT_PREFIX_CHARS = 200
+
+# ─── Persistent Score Cache ───
+SENTIMENT_CACHE_DIR = os.getenv("SENTIMENT_CACHE_DIR", "/tmp/sentiment_cache")
+_SCORE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+# Bump alongside model or threshold changes so stale scores are not reused
+_SCORE_CACHE_VERSION = f"v2|{EN_MODEL_ID}|{MULTI_MODEL_ID}"
+
 try:
-    en_model = pipeline("sentiment-analysis", model="distilbert-base-uncased-finetuned-sst-2-english")
-    multi_model = pipeline("sentiment-analysis", model="nlptown/bert-base-multilingual-uncased-sentiment")
+    import diskcache
+    _SCORE_CACHE = diskcache.Cache(SENTIMENT_CACHE_DIR)
 except Exception as e:
-    log.exception("Failed to load sentiment models: %s", e)
-    en_model = None
-    multi_model = None
+    log.warning("Sentiment score cache unavailable: %s", e)
+    _SCORE_CACHE = None
 
 # ─── Lexicons for Indian Languages ───
 _POSITIVE_WORDS = {
@@ -32,50 +144,243 @@ _NEGATIVE_WORDS = {
     "problem", "fail", "angry", "issue", "bura", "galat", "ghatak", "kharaab", "mosamana", "ketta"
 }
 
-def lexicon_sentiment(text: str) -> Tuple[str, float]:
-    tokens = re.findall(r'\w+', text.lower())
-    pos_hits = sum(1 for t in tokens if t in _POSITIVE_WORDS)
-    neg_hits = sum(1 for t in tokens if t in _NEGATIVE_WORDS)
+_MULTI_LANGS = {"hi", "ta", "mr", "bn", "gu", "kn", "ml", "ur"}
+_BATCH_SIZE = 32
+# Most Reddit comments are far shorter; attention cost grows with the square of this
+_MAX_TOKENS = 128
+# Lexicon results with enough hits at or above this confidence skip the transformer entirely
+_LEXICON_CONFIDENT = 0.6
+_LEXICON_MIN_HITS = 2
+
+_WORD_RE = re.compile(r'\w+')
+_LEXICON_SCORE = {**{w: 1 for w in _POSITIVE_WORDS}, **{w: -1 for w in _NEGATIVE_WORDS}}
+
+def _lexicon_score(text: str) -> Tuple[Tuple[str, float], int]:
+    """Return the lexicon (label, confidence) together with the number of lexicon hits."""
+    pos_hits = neg_hits = 0
+    for match in _WORD_RE.finditer(text.lower()):
+        value = _LEXICON_SCORE.get(match.group())
+        if value is None:
+            continue
+        if value > 0:
+            pos_hits += 1
+        else:
+            neg_hits += 1
     total_hits = pos_hits + neg_hits
 
     if total_hits == 0:
-        return "neutral", 0.0
+        return ("neutral", 0.0), 0
 
     score = (pos_hits - neg_hits) / total_hits
     confidence = round(min(abs(score), 1.0), 2)
 
     if score > 0:
-        return "positive", confidence
+        return ("positive", confidence), total_hits
     elif score < 0:
-        return "negative", confidence
+        return ("negative", confidence), total_hits
     else:
-        return "neutral", confidence
+        return ("neutral", confidence), total_hits
+
+def lexicon_sentiment(text: str) -> Tuple[str, float]:
+    return _lexicon_score(text)[0]
+
+def _lexicon_is_confident(result: Tuple[str, float], hits: int) -> bool:
+    # One hit always scores 1.0 ("I don't like this"), so a single word never skips the model
+    return hits >= _LEXICON_MIN_HITS and result[1] >= _LEXICON_CONFIDENT
+
+def _model_label(result: Dict[str, Any]) -> Tuple[str, float]:
+    label = result["label"].lower()
+    score = round(float(result["score"]), 2)
+    return (label, score) if score >= 0.6 else ("neutral", score)
+
+def _predict(model: Tuple[Any, Any], texts: List[str]) -> List[Dict[str, Any]]:
+    """
+    Classify texts with a (tokenizer, model) pair. Texts are tokenized once,
+    sorted by token length and padded per batch so short comments are not
+    padded up to the longest one in the whole input.
+    """
+    tokenizer, classifier = model
+    encoded = tokenizer(texts, truncation=True, max_length=_MAX_TOKENS)
+    order = sorted(range(len(texts)), key=lambda i: len(encoded["input_ids"][i]))
+    id2label = classifier.config.id2label
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(texts)
+    with torch.inference_mode():
+        for start in range(0, len(order), _BATCH_SIZE):
+            chunk = order[start:start + _BATCH_SIZE]
+            batch = tokenizer.pad(
+                [{k: encoded[k][i] for k in encoded.keys()} for i in chunk],
+                padding="longest",
+                return_tensors="pt",
+            )
+            probs = classifier(**batch).logits.softmax(-1)
+            scores, labels = probs.max(-1)
+            for i, score, label in zip(chunk, scores.tolist(), labels.tolist()):
+                results[i] = {"label": id2label[label], "score": score}
+    return results
+
+def _detect_langs(texts: List[str]) -> List[str]:
+    """Detect languages for many texts; fastText classifies the whole list in one call."""
+    if _LID is not None:
+        try:
+            # fastText predicts one line at a time and rejects embedded newlines
+            labels, _ = _LID.predict([t.replace("\n", " ") for t in texts])
+            return [l[0][len(_LID_LABEL_PREFIX):] if l else "unknown" for l in labels]
+        except Exception as e:
+            log.warning("fastText language ID failed, falling back to langdetect: %s", e)
+
+    return [_langdetect(text[:_LANGDETECT_PREFIX_CHARS]) for text in texts]
+
+@functools.lru_cache(maxsize=100_000)
+def _langdetect(prefix: str) -> str:
+    try:
+        return detect(prefix)
+    except Exception:
+        return "unknown"
+
+def _detect_lang(text: str) -> str:
+    # Indic scripts are never ASCII, so ASCII text goes straight to the English model
+    if text.isascii():
+        return "en"
+    return _detect_langs([text])[0]
+
+def _text_key(text: str) -> str:
+    return hashlib.blake2b(f"{_SCORE_CACHE_VERSION}|{text}".encode("utf-8"), digest_size=16).hexdigest()
 
 def score_sentiment(text: str) -> Tuple[str, float]:
     if not text or not text.strip():
         return "neutral", 0.0
 
+    key = _text_key(text)
+    if _SCORE_CACHE is not None:
+        cached = _SCORE_CACHE.get(key)
+        if cached is not None:
+            return tuple(cached)
+
+    result, is_fallback = _score_uncached(text)
+    if _SCORE_CACHE is not None and not is_fallback:
+        _SCORE_CACHE.set(key, result, expire=_SCORE_CACHE_TTL_SECONDS)
+    return result
+
+def _score_uncached(text: str) -> Tuple[Tuple[str, float], bool]:
+    """
+    Score one text. The flag is True when a missing or failing model forced a
+    fallback result, which must not be persisted.
+    """
+    (lex_label, lex_conf), hits = _lexicon_score(text)
+    if _lexicon_is_confident((lex_label, lex_conf), hits):
+        return (lex_label, lex_conf), False
+
+    lang = _detect_lang(text)
+    if lang == "en":
+        model = get_models()["en"]
+    elif lang in _MULTI_LANGS:
+        model = get_models()["multi"]
+    else:
+        return (lex_label, lex_conf), False
+
+    if model is None:
+        return (lex_label, lex_conf), True
+
     try:
-        lang = detect(text)
-    except Exception:
-        lang = "unknown"
+        return _model_label(_predict(model, [text])[0]), False
+    except Exception as e:
+        log.exception("Sentiment scoring failed: %s", e)
+        return ("neutral", 0.0), True
 
+def _run_model(model, texts: List[str], idx: List[int], out: List[Tuple[str, float]]) -> List[int]:
+    """
+    Score texts[idx] in batches and scatter the results back into out.
+    Returns the indices that fell back to the lexicon because the model failed.
+    """
+    if not idx:
+        return []
     try:
-        if lang == "en" and en_model:
-            result = en_model(text[:512])[0]
-            label = result["label"].lower()
-            score = round(float(result["score"]), 2)
-            return label, score if score >= 0.6 else ("neutral", score)
-
-        elif multi_model and lang in ["hi", "ta", "mr", "bn", "gu", "kn", "ml", "ur"]:
-            result = multi_model(text[:512])[0]
-            label = result["label"].lower()
-            score = round(float(result["score"]), 2)
-            return label, score if score >= 0.6 else ("neutral", score)
+        results = _predict(model, [texts[i] for i in idx])
+        for i, result in zip(idx, results):
+            out[i] = _model_label(result)
+        return []
+    except Exception as e:
+        log.exception("Batched sentiment scoring failed, falling back to lexicon: %s", e)
+        for i in idx:
+            out[i] = lexicon_sentiment(texts[i])
+        return idx
+
+def score_sentiment_batch(texts: List[str]) -> List[Tuple[str, float]]:
+    """
+    Score many texts at once, grouping them by language so each transformer
+    runs batched forward passes instead of one call per comment. Duplicate
+    texts are scored once, and previously seen texts come from the score cache.
+    """
+    out: List[Tuple[str, float]] = [("neutral", 0.0)] * len(texts)
+
+    groups: Dict[str, List[int]] = {}
+    for i, text in enumerate(texts):
+        if text and text.strip():
+            groups.setdefault(text, []).append(i)
+
+    misses: List[str] = []
+    for text, idx in groups.items():
+        # Cache hits never touch the models, so an all-hit batch skips loading them
+        cached = _SCORE_CACHE.get(_text_key(text)) if _SCORE_CACHE is not None else None
+        if cached is None:
+            misses.append(text)
+            continue
+        for i in idx:
+            out[i] = tuple(cached)
+
+    if not misses:
+        return out
+
+    scored, fallback = _score_batch_uncached(misses)
+    if _SCORE_CACHE is not None:
+        with _SCORE_CACHE.transact():
+            for j, (text, result) in enumerate(zip(misses, scored)):
+                if j not in fallback:
+                    _SCORE_CACHE.set(_text_key(text), result, expire=_SCORE_CACHE_TTL_SECONDS)
+    for text, result in zip(misses, scored):
+        for i in groups[text]:
+            out[i] = result
+    return out
+
+def _score_batch_uncached(texts: List[str]) -> Tuple[List[Tuple[str, float]], Set[int]]:
+    """Score texts, also returning the indices whose results are fallbacks and must not be persisted."""
+    out: List[Tuple[str, float]] = [("neutral", 0.0)] * len(texts)
+    en_idx: List[int] = []
+    multi_idx: List[int] = []
+    lid_idx: List[int] = []
 
+    for i, text in enumerate(texts):
+        if not text or not text.strip():
+            continue
+
+        out[i], hits = _lexicon_score(text)
+        if _lexicon_is_confident(out[i], hits):
+            continue
+
+        # Indic scripts are never ASCII, so ASCII text goes straight to the English model
+        if text.isascii():
+            en_idx.append(i)
         else:
-            return lexicon_sentiment(text)
+            lid_idx.append(i)
 
-    except Exception as e:
-        log.exception("Sentiment scoring failed: %s", e)
-        return "neutral", 0.0
\ No newline at end of file
+    if lid_idx:
+        for i, lang in zip(lid_idx, _detect_langs([texts[i] for i in lid_idx])):
+            if lang == "en":
+                en_idx.append(i)
+            elif lang in _MULTI_LANGS:
+                multi_idx.append(i)
+
+    fallback: Set[int] = set()
+    # Lexicon-settled and unsupported-language texts never load the models
+    if not en_idx and not multi_idx:
+        return out, fallback
+
+    # Without a model, texts keep the lexicon result already stored in out
+    models = get_models()
+    for name, idx in (("en", en_idx), ("multi", multi_idx)):
+        if models[name]:
+            fallback.update(_run_model(models[name], texts, idx, out))
+        else:
+            fallback.update(idx)
+    return out, fallback
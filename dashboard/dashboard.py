@@ -1,4 +1,6 @@
+import io
 import os
+import time
 import logging
 from typing import Optional
 
@@ -11,10 +13,43 @@ log = logging.getLogger(__name__)
 if not log.handlers:
     logging.basicConfig(level=logging.INFO)
 
+CACHE_DIR = os.getenv("DASHBOARD_CACHE_DIR", "/tmp")
+CACHE_TTL_SECONDS = 300
+
+# --- Primary DB loader ---
+def _read_from_db_via_connectorx(limit: int = 10000) -> pd.DataFrame:
+    """Stream rows straight into Arrow buffers instead of building Python tuples per row."""
+    import connectorx as cx
+
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        log.warning("DATABASE_URL not set")
+        return pd.DataFrame()
+
+    # connectorx takes a plain libpq URL, without SQLAlchemy's "+driver" suffix
+    scheme, sep, rest = db_url.partition("://")
+    cx_url = scheme.split("+", 1)[0] + sep + rest
+    sql = f"""
+        SELECT id, subreddit, comment_clean, sentiment, confidence, created_utc, url
+        FROM reddit_comments
+        ORDER BY created_utc DESC
+        LIMIT {int(limit)}
+    """
+    df = cx.read_sql(cx_url, sql, return_type="pandas", protocol="binary")
+    log.info(f"Loaded {len(df)} records from reddit_comments via connectorx")
+    return df
+
+# --- Shared SQLAlchemy engine ---
+@st.cache_resource
+def _get_engine(db_url: str):
+    """One pooled engine per process, reused across reruns and sessions."""
+    from sqlalchemy import create_engine
+    return create_engine(db_url)
+
 # --- Fallback DB loader ---
 def _read_from_db_via_sqlalchemy(limit: int = 10000) -> pd.DataFrame:
     try:
-        from sqlalchemy import create_engine, text
+        from sqlalchemy import text
     except Exception as e:
         log.exception("SQLAlchemy not available: %s", e)
         return pd.DataFrame()
@@ -26,7 +61,7 @@ def _read_from_db_via_sqlalchemy(limit: int = 10000) -> pd.DataFrame:
         return pd.DataFrame()
 
     try:
-        engine = create_engine(db_url)
+        engine = _get_engine(db_url)
         sql = text("""
             SELECT id, subreddit, comment_clean, sentiment, confidence, created_utc, url
             FROM reddit_comments
@@ -41,32 +76,106 @@ def _read_from_db_via_sqlalchemy(limit: int = 10000) -> pd.DataFrame:
         log.exception("DB query failed: %s", e)
         return pd.DataFrame()
 
-@st.cache_data(ttl=300)
+def _load_from_db(limit: int) -> pd.DataFrame:
+    try:
+        return _read_from_db_via_connectorx(limit=limit)
+    except Exception as e:
+        log.warning("connectorx load failed, falling back to SQLAlchemy: %s", e)
+    return _read_from_db_via_sqlalchemy(limit=limit)
+
+# --- Local Feather cache ---
+def _cache_path(limit: int) -> str:
+    return os.path.join(CACHE_DIR, f"reddit_comments_{limit}.arrow")
+
+def _read_cache(path: str) -> pd.DataFrame:
+    # Uncompressed Arrow IPC maps straight into memory, with nothing to decompress
+    import pyarrow.feather as feather
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+def _write_cache(df: pd.DataFrame, path: str) -> None:
+    # Write then rename so concurrent sessions never read a half-written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), tmp_path,
+                              compression="uncompressed")
+        os.replace(tmp_path, path)
+    except Exception as e:
+        log.warning("Failed to write cache %s: %s", path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Not wrapped in st.cache_data: a second TTL on top of the file's would double the staleness
 def get_data(limit: int = 10000) -> pd.DataFrame:
+    path = _cache_path(limit)
+    try:
+        if time.time() - os.path.getmtime(path) < CACHE_TTL_SECONDS:
+            df = _read_cache(path)
+            log.info(f"Loaded {len(df)} records from cache {path}")
+            return df
+    except OSError:
+        pass
+    except Exception as e:
+        log.warning("Failed to read cache %s: %s", path, e)
+
     try:
-        return _read_from_db_via_sqlalchemy(limit=limit)
+        df = _load_from_db(limit)
     except Exception as e:
         log.exception("Failed to load data: %s", e)
-        return pd.DataFrame()
+        df = pd.DataFrame()
+
+    if not df.empty:
+        _write_cache(df, path)
+        return df
+
+    # Serve a stale snapshot rather than nothing while the DB is unreachable
+    if os.path.exists(path):
+        try:
+            log.warning("DB returned no data, serving stale cache %s", path)
+            return _read_cache(path)
+        except Exception as e:
+            log.warning("Failed to read cache %s: %s", path, e)
+    return df
+
+# --- Aggregations over the loaded frame ---
+def _count_by(df: pd.DataFrame, col: str) -> pd.DataFrame:
+    # value_counts orders by count, largest first
+    counts = df[col].value_counts().reset_index()
+    counts.columns = [col, "count"]
+    # Categorical columns also report unused categories with a zero count
+    return counts[counts["count"] > 0]
+
+def _daily_counts(df: pd.DataFrame) -> pd.DataFrame:
+    # created_utc is already datetime after normalization; no frame copy needed
+    date = df["created_utc"].dt.floor("D").rename("date")
+    return df.groupby([date, "sentiment"], observed=True).size().reset_index(name="count")
+
+# --- Export ---
+def _to_csv_bytes(df: pd.DataFrame) -> bytes:
+    """Serialize with Arrow's C++ CSV writer instead of building one big Python str."""
+    buf = io.BytesIO()
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pcsv
+        pcsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    except Exception as e:
+        log.warning("Arrow CSV export failed, falling back to pandas: %s", e)
+        buf = io.BytesIO()
+        df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
 
 # --- Visual helpers ---
-def _subreddit_bar(df: pd.DataFrame):
-    counts = df["subreddit"].value_counts().reset_index()
-    counts.columns = ["subreddit", "count"]
+def _subreddit_bar(counts: pd.DataFrame):
     return px.bar(counts, x="subreddit", y="count", title="Comments by Subreddit", color="count")
 
-def _sentiment_pie(df: pd.DataFrame):
-    pie = df["sentiment"].value_counts().reset_index()
-    pie.columns = ["sentiment", "count"]
-    return px.pie(pie, names="sentiment", values="count", title="Sentiment Distribution")
+def _sentiment_pie(counts: pd.DataFrame):
+    return px.pie(counts, names="sentiment", values="count", title="Sentiment Distribution")
 
 def _confidence_histogram(df: pd.DataFrame):
     return px.histogram(df, x="confidence", nbins=20, title="Confidence Distribution")
 
-def _daily_trend(df: pd.DataFrame):
-    df = df.copy()
-    df["date"] = pd.to_datetime(df["created_utc"], errors="coerce").dt.date
-    trend = df.groupby(["date", "sentiment"]).size().reset_index(name="count")
+def _daily_trend(trend: pd.DataFrame):
     return px.line(trend, x="date", y="count", color="sentiment", title="Daily Trend by Sentiment")
 
 # --- Page layout ---
@@ -104,6 +213,9 @@ if df["created_utc"].dt.tz is None:
     except Exception:
         df["created_utc"] = pd.to_datetime(df["created_utc"], errors="coerce")
 
+# Few distinct labels: integer codes make filtering and grouping cheaper
+df["sentiment"] = df["sentiment"].astype("category")
+
 # Sidebar filters
 st.sidebar.header("Filters")
 subreddits = sorted(df["subreddit"].dropna().unique().tolist())
@@ -138,8 +250,7 @@ if comment_col:
 st.dataframe(table, use_container_width=True)
 
 # CSV export
-csv = filtered_df.to_csv(index=False)
-st.download_button("Download Filtered Data", csv, "filtered_data.csv", mime="text/csv")
+st.download_button("Download Filtered Data", _to_csv_bytes(filtered_df), "filtered_data.csv", mime="text/csv")
 
 # Plotting
 def safe_plot(func, df_, title, color_override: Optional[str] = None):
@@ -156,9 +267,14 @@ def safe_plot(func, df_, title, color_override: Optional[str] = None):
         log.exception("Plot failed %s: %s", title, e)
         st.warning(f"Failed to render {title}")
 
-safe_plot(_subreddit_bar, filtered_df, "Comments by Subreddit", color_override="blue")
-safe_plot(_sentiment_pie, filtered_df, "Sentiment Distribution")
+# Filter changes regroup the loaded frame; no extra DB round trips
+by_subreddit = _count_by(filtered_df, "subreddit")
+by_sentiment = _count_by(filtered_df, "sentiment")
+daily = _daily_counts(filtered_df)
+
+safe_plot(_subreddit_bar, by_subreddit, "Comments by Subreddit", color_override="blue")
+safe_plot(_sentiment_pie, by_sentiment, "Sentiment Distribution")
 safe_plot(_confidence_histogram, filtered_df, "Confidence Histogram")
-safe_plot(_daily_trend, filtered_df, "Daily Trend by Sentiment")
+safe_plot(_daily_trend, daily, "Daily Trend by Sentiment")
 
 st.markdown("Built with Streamlit. Data refreshed every 5 minutes.")
\ No newline at end of file